@@ -3,29 +3,67 @@ reads your music library and download synchronized lyrics (as .lrc files)
 """
 # Base
 import asyncio
+import json
+import os
 import re
-import urllib
+import sys
+import time
+import urllib.parse
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import Dict, Iterator, NamedTuple, Tuple, Optional
 
 # Installed
 import aiofiles
-import aiohttp
+import httpx
 import logzero
+import lxml.etree
+import lxml.html
 import mutagen
-from bs4 import BeautifulSoup
+import mutagen.flac
+import mutagen.id3
+import mutagen.mp4
+import mutagen.oggopus
 from logzero import logger
+from lxml.etree import XPath
 
 BASE_URL = "https://www.lyricsify.com"
 MAX_SIMULTANEOUS_REQUESTS = 10
+MAX_PENDING_FILES = 4 * MAX_SIMULTANEOUS_REQUESTS
+HTTP_TIMEOUT = 5 * 60  # Same as the aiohttp default, in seconds
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SUPPORTED_EXTENSIONS = {'.mp3', '.flac', '.m4a', '.mp4', '.opus', '.ogg'}
 HTTP_HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
                               "Chrome/96.0.4664.110 Safari/537.36",
                 "Upgrade-Insecure-Requests": "1",
-                "Accept-encoding": "gzip, deflate"}
+                "Accept-Encoding": "br, gzip, deflate"}
+
+
+class TrackInfo(NamedTuple):
+    """
+    The information read from the tags of a music file
+    """
+    artist: str
+    album: str
+    track: int
+    title: str
+
+
+# Compiled queries used to navigate the downloaded pages
+_TITLE_XPATH = XPath("(//a[contains(concat(' ', normalize-space(@class), ' '), ' title ') and @href])[1]")
+_LRC_SPAN_XPATH = XPath("(//span[substring(normalize-space(text()), "
+                        "string-length(normalize-space(text())) - 3) = '.lrc']/..)[1]")
+_CLICK_XPATH = XPath("(//a[normalize-space(text())='click here'])[1]")
+
+# Track number, with an optional total number of tracks ("3" or "3/12")
+_TRCK_RE = re.compile(r"(\d+)(?:/\d+)?")
 
 # Specify your music library location here :
 LIBRARY_PATH = "D:/Music"
 
+# Files for which no lyrics were found are remembered in this file, and skipped for some time
+MISSING_LYRICS_FILE = ".missing_lyrics.json"
+MISSING_LYRICS_RETRY_DELAY = 30 * 24 * 60 * 60  # 30 days, in seconds
+
 
 async def download_all_lyrics():
     """
@@ -36,128 +74,310 @@ async def download_all_lyrics():
 
     Currently, supported file formats are MP3, FLAC, Ogg (Opus) and MP4/M4A
     """
-    root_path = Path(LIBRARY_PATH)
-
-    async_tasks = []
-    semaphore = asyncio.Semaphore(MAX_SIMULTANEOUS_REQUESTS)
-
-    for path in root_path.rglob("*.*"):
-        logger.debug(f"Found '{path}'")
-        task = asyncio.create_task(download_lyrics(semaphore, path))
-        async_tasks.append(task)
+    pending_tasks = set()
+    search_cache = {}
 
-    return await asyncio.gather(*async_tasks)
+    missing_lyrics_path = Path(LIBRARY_PATH) / MISSING_LYRICS_FILE
+    missing_lyrics = load_missing_lyrics(missing_lyrics_path)
 
+    # Limit the number of concurrent requests, HTTP/2 multiplexes them regardless of the connection limit
+    semaphore = asyncio.Semaphore(MAX_SIMULTANEOUS_REQUESTS)
 
-async def download_lyrics(semaphore: asyncio.Semaphore, file: Path) -> None:
+    # Share a single client so that connections to the server are kept alive and reused
+    # With HTTP/2, concurrent requests to the server are multiplexed on a single connection
+    limits = httpx.Limits(max_connections=MAX_SIMULTANEOUS_REQUESTS)
+    timeout = httpx.Timeout(HTTP_TIMEOUT)
+    async with httpx.AsyncClient(http2=True, headers=HTTP_HEADERS, limits=limits, timeout=timeout,
+                                 follow_redirects=True) as client:
+        try:
+            for file_path, has_lrc_file in find_music_files(LIBRARY_PATH):
+                logger.debug("Found '%s'", file_path)
+                path = Path(file_path)
+
+                # Skip files which already have lyrics before spawning any task
+                if has_lrc_file:
+                    lrc_file_path = path.with_suffix('.lrc')
+                    if await check_lrc_file(lrc_file_path):
+                        logger.debug("Skipping existing file '%s'", lrc_file_path)
+                        continue
+
+                # Skip files for which no lyrics were found recently
+                if str(path) in missing_lyrics:
+                    logger.debug("Skipping file without lyrics '%s'", path)
+                    continue
+
+                # Wait for a file to be processed before starting a new one
+                # HTTP requests are limited separately by the semaphore, only once they are actually needed
+                if len(pending_tasks) >= MAX_PENDING_FILES:
+                    done_tasks, pending_tasks = await asyncio.wait(pending_tasks,
+                                                                   return_when=asyncio.FIRST_COMPLETED)
+                    for task in done_tasks:
+                        task.result()
+
+                pending_tasks.add(asyncio.create_task(download_lyrics(client, semaphore, search_cache,
+                                                                     missing_lyrics, path)))
+
+            if pending_tasks:
+                await asyncio.gather(*pending_tasks)
+        finally:
+            save_missing_lyrics(missing_lyrics_path, missing_lyrics)
+
+
+async def download_lyrics(client: httpx.AsyncClient,
+                          semaphore: asyncio.Semaphore,
+                          search_cache: Dict[Tuple[str, str], asyncio.Task],
+                          missing_lyrics: Dict[str, float],
+                          file: Path) -> None:
     """
     Download the lyrics for the specified music file
 
-    The process goes as follows :
-    1) Skip the current file if the lyrics are already present
-    2) Read the embedded tags of the music file to extract artist and title information
-    3) Generate the URL and download the web page for the search results on https://syair.info
-    4) Generate the URL and download the web page for the first result of the search
-    5) Generate the URL and download the final .lrc file
+    Files which already have lyrics are expected to be filtered out by the caller.
 
-    :param semaphore: A semaphore object to limit the number of concurrent downloads
+    The process goes as follows :
+    1) Read the embedded tags of the music file to extract artist and title information
+    2) Find the URL of the .lrc file, reusing the search of any other file with the same artist and title
+    3) Download the final .lrc file
+
+    :param client: An open HTTP client shared by all downloads
+    :param semaphore: A semaphore object to limit the number of concurrent requests
+    :param search_cache: The searches already started, indexed by artist and title
+    :param missing_lyrics: The files for which no lyrics were found, with the time of the search
     :param file: The input music file
     """
-    logger.debug(f"Downloading lyrics for '{file}'")
+    logger.debug("Downloading lyrics for '%s'", file)
 
-    # 1) Skip everything if we are parsing a lyrics file
-    if file.suffix == '.lrc':
-        logger.debug(f"Skipping lyrics file '{file}'")
+    # 1) Read the embedded tags of the music file to extract artist and title information
+    # Tag parsing is blocking disk I/O, run it in a worker thread to keep the event loop free
+    track_info = await asyncio.to_thread(read_tags_from_file, file)
+    if track_info is None:
+        logger.error("Aborted downloading '%s' (Unsupported format)", file)
         return
 
-    # 2) Skip the current file if the lyrics are already present
-    lrc_file_path = file.with_suffix('.lrc')
-    logger.debug(f"Destination file '{lrc_file_path}'")
-    if lrc_file_path.exists():
-        async with aiofiles.open(lrc_file_path, mode='rb') as f:
-            start_line = await f.readline()
-
-        if b'[' not in start_line or b']' not in start_line:
-            logger.error(f"Corrupted LRC file '{lrc_file_path}', cleaning it up")
-            lrc_file_path.unlink()
-        else:
-            logger.debug(f"Skipping existing file '{lrc_file_path}'")
-            return
+    # 2) Find the URL of the .lrc file
+    search_key = (track_info.artist.casefold(), track_info.title.casefold())
+    if search_key not in search_cache:
+        search_cache[search_key] = asyncio.create_task(
+            find_lrc_file_link(client, semaphore, track_info.artist, track_info.title))
+    else:
+        logger.debug("Reusing search for '%s - %s'", track_info.artist, track_info.title)
 
-    # 3) Read the embedded tags of the music file to extract artist and title information
-    tags = read_tags_from_file(file)
-    if tags is None:
-        logger.error(f"Aborted downloading '{file}' (Unsupported format)")
+    # Network errors and error pages (rate limiting, server errors...) must not be mistaken for missing lyrics
+    try:
+        lrc_file_link = await search_cache[search_key]
+    except (httpx.HTTPError, lxml.etree.ParserError) as e:
+        logger.error("Aborted downloading '%s' (%s)", file, e)
         return
 
-    async with semaphore, aiohttp.ClientSession(headers=HTTP_HEADERS) as session:
-        # 4) Generate the URL and download the web page for the search results
-        artist, _, _, title = tags
-        search_url = make_search_url(artist, title)
-        search_soup = await download_url(session, search_url)
+    if lrc_file_link is None:
+        logger.error("Aborted downloading '%s' (Could not find lyrics file)", file)
+        missing_lyrics[str(file)] = time.time()
+        return
 
-        # 5) Generate the URL and download the web page for the first result of the search
-        lyrics_tag = search_soup.find("a", href=True, class_="title")
-        if lyrics_tag is None:
-            logger.error(f"Aborted downloading '{file}' (Could not find lyrics file)")
-            return
+    # 3) Download the final .lrc file
+    lrc_file_path = file.with_suffix('.lrc')
+    logger.debug("Destination file '%s'", lrc_file_path)
+    try:
+        await download_file(client, semaphore, lrc_file_link, lrc_file_path)
+    except httpx.HTTPError as e:
+        logger.error("Aborted downloading '%s' (%s)", file, e)
+        return
+
+    logger.info("Finished downloading '%s'", lrc_file_path)
+
+
+def load_missing_lyrics(path: Path) -> Dict[str, float]:
+    """
+    Load the files for which no lyrics were found during the previous runs
+
+    Entries older than the retry delay are dropped, so that these files are searched again.
+
+    :param path: The JSON file storing the files without lyrics
+    :return: The files without lyrics, with the time of the search
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            missing_lyrics = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.error("Could not load '%s', ignoring it (%s)", path, e)
+        return {}
+
+    if not isinstance(missing_lyrics, dict):
+        logger.error("Could not load '%s', ignoring it (Unexpected content)", path)
+        return {}
+
+    # Invalid entries are dropped along with the expired ones
+    now = time.time()
+    return {file: searched_at for file, searched_at in missing_lyrics.items()
+            if isinstance(searched_at, (int, float)) and not isinstance(searched_at, bool)
+            and now - searched_at < MISSING_LYRICS_RETRY_DELAY}
+
+
+def save_missing_lyrics(path: Path, missing_lyrics: Dict[str, float]) -> None:
+    """
+    Save the files for which no lyrics were found, to skip them during the next runs
+
+    :param path: The JSON file storing the files without lyrics
+    :param missing_lyrics: The files without lyrics, with the time of the search
+    """
+    try:
+        with open(path, mode='w', encoding='utf-8') as f:
+            json.dump(missing_lyrics, f, ensure_ascii=False, indent=1)
+    except OSError as e:
+        logger.error("Could not save '%s' (%s)", path, e)
+
+
+async def find_lrc_file_link(client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                             artist: str, title: str) -> Optional[str]:
+    """
+    Browse the website to find the download URL of the lyrics for a song
+
+    The process goes as follows :
+    1) Generate the URL and download the web page for the search results
+    2) Generate the URL and download the web page for the first result of the search
+    3) Generate the URL and download the download page
+    4) Extract the final URL
+
+    :param client: An open HTTP client to execute the requests
+    :param semaphore: A semaphore object to limit the number of concurrent requests
+    :param artist: Artist name
+    :param title: Title
+    :return: The URL of the .lrc file, or None if no lyrics were found
+    """
+    # 1) Generate the URL and download the web page for the search results
+    search_url = make_search_url(artist, title)
+    search_page = await download_url(client, semaphore, search_url)
 
-        lyrics_link = lyrics_tag['href']
-        logger.debug(f"Found lyrics link '{lyrics_link}'")
-        lyrics_url = BASE_URL + lyrics_link
-        logger.debug(f"Generated link URL '{lyrics_url}'")
-        lyrics_soup = await download_url(session, lyrics_url)
+    # 2) Generate the URL and download the web page for the first result of the search
+    lyrics_tags = _TITLE_XPATH(search_page)
+    if not lyrics_tags:
+        return None
 
-        # 6) Generate the URL for the download page
-        lrc_download_link = lyrics_soup.find("span", text=re.compile(r".*\.lrc")).parent['href']
-        logger.debug(f"Found LRC download page URL '{lrc_download_link}'")
-        lyrics_file_soup = await download_url(session, lrc_download_link)
+    lyrics_link = lyrics_tags[0].get('href')
+    logger.debug("Found lyrics link '%s'", lyrics_link)
+    lyrics_url = BASE_URL + lyrics_link
+    logger.debug("Generated link URL '%s'", lyrics_url)
+    lyrics_page = await download_url(client, semaphore, lyrics_url)
 
-        # 7) Generate the final URL
-        lrc_file_link = lyrics_file_soup.find("a", text="click here")['href']
-        logger.debug(f"Found LRC download URL '{lrc_file_link}'")
-        await download_file(session, lrc_file_link, lrc_file_path)
+    # 3) Generate the URL for the download page
+    lrc_download_tags = _LRC_SPAN_XPATH(lyrics_page)
+    if not lrc_download_tags:
+        return None
 
-    logger.info(f"Finished downloading '{lrc_file_path}'")
+    lrc_download_link = lrc_download_tags[0].get('href')
+    logger.debug("Found LRC download page URL '%s'", lrc_download_link)
+    lyrics_file_page = await download_url(client, semaphore, lrc_download_link)
 
+    # 4) Generate the final URL
+    lrc_file_tags = _CLICK_XPATH(lyrics_file_page)
+    if not lrc_file_tags:
+        return None
 
-def read_tags_from_file(file: Path) -> Optional[Tuple[str, str, int, str]]:
+    lrc_file_link = lrc_file_tags[0].get('href')
+    logger.debug("Found LRC download URL '%s'", lrc_file_link)
+    return lrc_file_link
+
+
+def find_music_files(root: str) -> Iterator[Tuple[str, bool]]:
+    """
+    Recursively list the supported music files in a directory
+
+    Lyrics files are looked up while browsing, since they are stored next to the music files.
+
+    :param root: The directory to browse
+    :return: The paths of the music files found, and whether a lyrics file already exists for each of them
+    """
+    directories = [root]
+
+    while directories:
+        music_files = []
+        lrc_names = set()
+
+        with os.scandir(directories.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+
+                # Follow the case sensitivity of the filesystem, like a lookup of the lyrics file would
+                name, extension = os.path.splitext(entry.name)
+                if os.path.normcase(extension) == '.lrc':
+                    lrc_names.add(os.path.normcase(name))
+                elif extension.lower() in SUPPORTED_EXTENSIONS:
+                    music_files.append((os.path.normcase(name), entry.path))
+
+        for name, path in music_files:
+            yield path, name in lrc_names
+
+
+async def check_lrc_file(lrc_file_path: Path) -> bool:
+    """
+    Check that an existing lyrics file is valid, and remove it if it is corrupted
+
+    :param lrc_file_path: The lyrics file to check
+    :return: True if the lyrics file is valid, False if it was removed
+    """
+    async with aiofiles.open(lrc_file_path, mode='rb') as f:
+        start_line = await f.readline()
+
+    if b'[' not in start_line or b']' not in start_line:
+        logger.error("Corrupted LRC file '%s', cleaning it up", lrc_file_path)
+        lrc_file_path.unlink()
+        return False
+
+    return True
+
+
+def read_tags_from_file(file: Path) -> Optional[TrackInfo]:
     """
     Read the artist and title information from a music file
-    Currently supported file formats are .mp3 and .flac
+    Currently supported file formats are .mp3, .flac, .opus, .ogg (Opus), .m4a and .mp4
     :param file: Input music file
-    :return: Artist name and title as strings
+    :return: The track information, or None if the tags could not be read
     """
     try:
-        logger.debug(f"Trying to load '{file}'")
+        logger.debug("Trying to load '%s'", file)
 
-        tags = mutagen.File(file)
+        # Pick the tag reader from the extension, to avoid probing every supported format
+        suffix = file.suffix.lower()
+        match suffix:
+            case '.mp3':
+                tags = mutagen.id3.ID3(file, translate=False)
 
-        match type(tags):
-            case mutagen.mp3.MP3:
                 try:
-                    artist = tags.tags.getall('TPE1')[0].text[0]
+                    artist = tags.getall('TPE1')[0].text[0]
                 except IndexError as e:
                     logger.debug(e)
                     artist = ''
 
                 try:
-                    album = tags.tags.getall('TALB')[0].text[0]
+                    album = tags.getall('TALB')[0].text[0]
                 except IndexError as e:
                     logger.debug(e)
                     album = ''
 
                 try:
-                    track = int(re.match(r"(\d+)(?:/\d+)?", tags.tags.getall('TRCK')[0].text[0])[1])
+                    track = int(_TRCK_RE.match(tags.getall('TRCK')[0].text[0])[1])
                 except IndexError as e:
                     logger.debug(e)
                     track = 0
 
-                title = tags.tags.getall('TIT2')[0].text[0]
-                logger.debug(f"Loaded MP3 file: '{artist} / {album} / {track} - {title}'")
-                return artist, album, track, title
+                title = tags.getall('TIT2')[0].text[0]
+                logger.debug("Loaded MP3 file: '%s / %s / %s - %s'", artist, album, track, title)
+                return TrackInfo(artist, album, track, title)
+
+            case '.flac' | '.opus' | '.ogg':
+                # Work directly on the tags rather than going through the file object for each lookup
+                if suffix == '.flac':
+                    tags = mutagen.flac.FLAC(file).tags
+                else:
+                    tags = mutagen.oggopus.OggOpus(file).tags
+
+                if tags is None:
+                    logger.debug("Found no tags in '%s'", file)
+                    return None
 
-            case mutagen.flac.FLAC | mutagen.oggopus.OggOpus:
                 try:
                     artist = tags['artist'][0]
                 except (KeyError, IndexError) as e:
@@ -171,16 +391,22 @@ def read_tags_from_file(file: Path) -> Optional[Tuple[str, str, int, str]]:
                     album = ''
 
                 try:
-                    track = int(re.match(r"(\d+)(?:/\d+)?", tags['tracknumber'][0])[1])
+                    track = int(_TRCK_RE.match(tags['tracknumber'][0])[1])
                 except (KeyError, IndexError) as e:
                     logger.debug(e)
                     track = 0
 
                 title = tags['title'][0]
-                logger.debug(f"Loaded FLAC/Opus file: '{artist} / {album} / {track} - {title}'")
-                return artist, album, track, title
+                logger.debug("Loaded FLAC/Opus file: '%s / %s / %s - %s'", artist, album, track, title)
+                return TrackInfo(artist, album, track, title)
+
+            case '.m4a' | '.mp4':
+                tags = mutagen.mp4.MP4(file).tags
+
+                if tags is None:
+                    logger.debug("Found no tags in '%s'", file)
+                    return None
 
-            case mutagen.mp4.MP4:
                 try:
                     artist = tags['\xa9ART'][0]
                 except (KeyError, IndexError) as e:
@@ -197,13 +423,13 @@ def read_tags_from_file(file: Path) -> Optional[Tuple[str, str, int, str]]:
                     track = int(tags['trkn'][0][0])
                 except (KeyError, IndexError) as e:
                     logger.debug(e)
-                    track = ''
+                    track = 0
 
                 title = tags['\xa9nam'][0]
-                logger.debug(f"Loaded MP4/M4A file: '{artist} / {album} / {track} - {title}'")
-                return artist, album, track, title
+                logger.debug("Loaded MP4/M4A file: '%s / %s / %s - %s'", artist, album, track, title)
+                return TrackInfo(artist, album, track, title)
             case _:
-                logger.debug(f"Found unsupported file: '{tags}'")
+                logger.debug("Found unsupported file: '%s'", file)
 
     except mutagen.MutagenError as e:
         logger.debug(e)
@@ -220,53 +446,107 @@ def make_search_url(artist: str, title: str) -> str:
     :return: The full search URL
     """
     search_url = BASE_URL + "/search?q=" + urllib.parse.quote_plus(artist + " " + title)
-    logger.debug(f"Generated search URL '{search_url}'")
+    logger.debug("Generated search URL '%s'", search_url)
     return search_url
 
 
-async def download_url(session: aiohttp.ClientSession, url: str) -> BeautifulSoup:
+async def download_url(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, url: str) -> lxml.html.HtmlElement:
     """
     Download and parse the provided URL
 
-    :param session: An open HTTP session to execute the request
+    :param client: An open HTTP client to execute the request
+    :param semaphore: A semaphore object to limit the number of concurrent requests
     :param url: The requested URL
-    :return: A BeautifulSoup object initialized with the contents of the downloaded page
+    :return: The root element of the downloaded page
+    """
+    logger.debug("Downloading HTML at '%s'", url)
+
+    async with semaphore:
+        response = await client.get(url)
+    response.raise_for_status()
+
+    # Parsing is CPU bound, run it in a worker thread to keep the other downloads going
+    return await asyncio.to_thread(parse_html, response.content, response.charset_encoding)
+
+
+def parse_html(html_content: bytes, charset: Optional[str]) -> lxml.html.HtmlElement:
     """
-    logger.debug(f"Downloading HTML at '{url}'")
+    Parse the raw contents of a web page
+
+    lxml decodes the raw bytes itself while parsing.
+
+    :param html_content: The raw contents of the page
+    :param charset: The charset sent by the server, if any
+    :return: The root element of the page
+    :raises lxml.etree.ParserError: If the page is empty
+    """
+    # Without a charset in the headers, let lxml detect it from the page itself
+    if charset is None:
+        return lxml.html.fromstring(html_content)
+
+    try:
+        parser = lxml.html.HTMLParser(encoding=charset)
+    except LookupError:
+        logger.debug("Unknown charset '%s', detecting it from the page instead", charset)
+        return lxml.html.fromstring(html_content)
 
-    async with session.get(url) as response:
-        html_content = await response.text('latin-1')
-        return BeautifulSoup(html_content, "html.parser")
+    return lxml.html.fromstring(html_content, parser=parser)
 
 
-async def download_file(session: aiohttp.ClientSession, url: str, destination: Path) -> None:
+async def download_file(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, url: str, destination: Path) -> None:
     """
     Download the provided URL as a file
 
-    :param session: An open HTTP session to execute the request
+    :param client: An open HTTP client to execute the request
+    :param semaphore: A semaphore object to limit the number of concurrent requests
     :param url: The requested URL
     :param destination: The output file destination
     """
-    logger.debug(f"Downloading file at '{url}' in '{destination}'")
-
-    async with session.get(url) as response:
-        file_content = await response.read()
+    logger.debug("Downloading file at '%s' in '%s'", url, destination)
+
+    async with semaphore, client.stream('GET', url) as response:
+        response.raise_for_status()
+        chunks = response.aiter_bytes(DOWNLOAD_CHUNK_SIZE)
+
+        # Only buffer the beginning of the file, until it is known to look like an LRC file
+        file_header = b''
+        async for chunk in chunks:
+            file_header += chunk
+            if b'[' in file_header and b']' in file_header:
+                break
+        else:
+            logger.error("Corrupted LRC file '%s', not writing it", destination)
+            return
 
-    if b'[' not in file_content or b']' not in file_content:
-        logger.error(f"Corrupted LRC file '{destination}', not writing it")
-        return
+        # Write to a temporary file first, so that an interrupted download never leaves a truncated LRC file
+        partial_destination = destination.with_name(destination.name + '.part')
+        try:
+            async with aiofiles.open(partial_destination, mode='wb') as f:
+                await f.write(file_header)
+                async for chunk in chunks:
+                    await f.write(chunk)
+        except BaseException:
+            partial_destination.unlink(missing_ok=True)
+            raise
 
-    async with aiofiles.open(destination, mode='wb') as f:
-        await f.write(file_content)
+    os.replace(partial_destination, destination)
 
 
 if __name__ == "__main__":
-    DO_PROFILING = False
+    DO_PROFILING = "--profile" in sys.argv
 
     import asyncio
 
-    # Workaround buggy event loop on Windows
-    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    if sys.platform == 'win32':
+        # Workaround buggy event loop on Windows
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    else:
+        # Use the faster libuv based event loop when it is available
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
 
     # Setup Logging
     # logzero.logfile("logs/logfile.log", maxBytes=1e9, backupCount=1)